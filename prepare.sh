@@ -5,6 +5,13 @@ sudo mkdir -p /var/lib/spinup/images
 sudo chown root:kvm /var/lib/spinup -R
 sudo chmod g+w /var/lib/spinup -R
 
+# copy-on-write badly fragments vm images on btrfs; files created in a
+# directory marked +C inherit the flag.
+if [ "$(stat -f -c %T /var/lib/spinup/images)" = "btrfs" ]; then
+    echo "Disabling copy-on-write for images..."
+    sudo chattr +C /var/lib/spinup/images
+fi
+
 sudo gpasswd -a $(whoami) kvm
 array=$(groups)
 if [[ "${array[@]}" =~ "libvirtd" ]]; then
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import io
 import os
 import sys
 import subprocess
@@ -7,41 +8,65 @@ import uuid
 import socket
 import time
 import re
+import json
 import base64
 import pickle
-import yaml
+import copy
 import random
+import hashlib
+import lzma
+import zlib
+import bz2
+import threading
 import libvirt
-import requests
-import yarl
 import xml.etree.ElementTree as ET
-from tempfile import mkdtemp
-from collections import Counter
-from multiprocessing import Pool, Queue, Process
+from collections import Counter, deque
+from itertools import islice
+from types import MappingProxyType
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from ipaddress import ip_interface, ip_address
-from tqdm import tqdm
+
+# the heavier third-party modules that are only needed for creating
+# machines (yaml, pycdlib, requests, yarl, tqdm) are imported inside
+# the functions using them, to keep the other commands quick to start.
 
 LIBVIRT_URI = 'qemu:///system'
 
 BASE_IMAGE_DIR = '/var/lib/spinup/images'
 
-xml_template = '''
-<domain type='kvm'>
-  <name>{cluster_id}-{name}</name>
-  <uuid>{uuid}</uuid>
-  <title>{name}</title>
-  <description>{description}</description>
+WARM_IMAGE_DIR = os.path.join(BASE_IMAGE_DIR, '_warm')
+
+DEFAULT_USERNAMES = MappingProxyType({
+    'ubuntu': 'ubuntu',
+    'centos': 'centos',
+    'coreos': 'core',
+})
+
+SPINUP_NAMESPACE = 'http://spinup.io/instance'
+ET.register_namespace('spinup', SPINUP_NAMESPACE)
+
+# the xml templates are parsed once at import time; each use fills in
+# a deep copy, which also takes care of escaping the values.
+#
+# the domain template is filled in for each machine in
+# build_domain_xml.
+domain_template = ET.fromstring('''<domain type='kvm'>
+  <name/>
+  <uuid/>
+  <title/>
+  <description/>
   <metadata>
     <spinup:instance xmlns:spinup='http://spinup.io/instance'>
-      <spinup:path>{path}</spinup:path>
-      <spinup:pickled-machine>{pickled_machine}</spinup:pickled-machine>
+      <spinup:path/>
+      <spinup:machine/>
     </spinup:instance>
   </metadata>
   <os>
     <type>hvm</type>
   </os>
-  <memory unit='MiB'>{memory}</memory>
-  <vcpu>{cpus}</vcpu>
+  <memory unit='MiB'/>
+  <vcpu/>
 
   <features>
     <acpi/>
@@ -54,8 +79,8 @@ xml_template = '''
       <type>hvm</type>
     </os>
     <disk type='file' device='disk'>
-      <driver name='qemu' type='qcow2'/>
-      <source file='{disk_image}'/>
+      <driver name='qemu' type='qcow2' discard='unmap'/>
+      <source/>
       <backingStore/>
       <target dev='vda' bus='virtio'/>
       <alias name='virtio-disk0'/>
@@ -63,7 +88,7 @@ xml_template = '''
     </disk>
     <disk type='file' device='cdrom'>
       <driver name='qemu' type='raw'/>
-      <source file='{config_drive}'/>
+      <source/>
       <backingStore/>
       <target dev='hda' bus='ide'/>
       <readonly/>
@@ -80,39 +105,45 @@ xml_template = '''
       <target type='serial' port='0'/>
       <alias name='serial0'/>
     </console>
-    {network_xml}
     <filesystem type='mount' accessmode='mapped'>
-      <source dir='{path}'/>
+      <source/>
       <target dir='spinup'/>
     </filesystem>
   </devices>
 
 </domain>
-'''
+''')
 
-def run_cmd(cmd):
-    if isinstance(cmd, str):
-        cmd = cmd.split(' ')
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE, shell=False)
-    out, err = proc.communicate()
-    return proc.returncode, out, err
+def _run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
 
-def get_default_username(machine):
-    return {
-        'ubuntu': 'ubuntu',
-        'centos': 'centos',
-        'coreos': 'core',
-    }[machine['os_variant']]
+def start_event_loop():
+    # this needs to be called before the connection is opened,
+    # otherwise no events are delivered on it.
+    libvirt.virEventRegisterDefaultImpl()
+    threading.Thread(target=_run_event_loop, daemon=True).start()
 
-def create_cloud_config_drive(machine):
-    print('{}: Creating config drive...'.format(machine['name']))
+def run_cmd(argv, timeout=None):
+    result = subprocess.run(argv, capture_output=True, timeout=timeout)
+    return result.returncode, result.stdout, result.stderr
+
+def read_public_key():
     with open(os.path.expanduser('~/.ssh/id_rsa.pub')) as f:
-        public_key = f.read()
+        return f.read()
+
+def create_cloud_config_drive(machine):
+    import yaml
+    import pycdlib
+    try:
+        # use libyaml's emitter when it's available
+        from yaml import CSafeDumper as SafeDumper
+    except ImportError:
+        from yaml import SafeDumper
 
-    public_key = public_key.strip()
-    public_key = public_key.strip()[public_key.index(' ') + 1:]
-    public_key = public_key.strip()[:public_key.index(' ')]
+    print('{}: Creating config drive...'.format(machine['name']))
+    # the key file looks like "<type> <base64 key> [comment]"
+    key_type, key_b64 = read_public_key().split(None, 2)[:2]
 
     meta_data = {
         'instance-id': machine['instance_id'],
@@ -124,15 +155,17 @@ def create_cloud_config_drive(machine):
         'network-interfaces': '',
     }
 
-    meta_data = yaml.dump(meta_data)
+    meta_data = yaml.dump(meta_data, Dumper=SafeDumper,
+                          default_flow_style=False).encode()
 
     user_data = {
         'hostname': machine['hostname'],
 
         'ssh_authorized_keys': [
-            'ssh-rsa {public_key} {username}@{hostname}'.format(
-                username=get_default_username(machine),
-                public_key=public_key,
+            '{key_type} {key_b64} {username}@{hostname}'.format(
+                key_type=key_type,
+                key_b64=key_b64,
+                username=DEFAULT_USERNAMES[machine['os_variant']],
                 hostname=machine['hostname'])
         ],
 
@@ -197,6 +230,12 @@ def create_cloud_config_drive(machine):
         if 'dns' in network:
             unit_file += 'DNS={}\n'.format(**network)
 
+        # networkd derives its dhcp client id from the machine id by
+        # default, which machines started from the same warm image
+        # share. dnsmasq would then give all of them the same lease.
+        if network['ip'] == 'dhcp':
+            unit_file += '\n[DHCP]\nClientIdentifier=mac\n'
+
         user_data['write_files'].append({
             'name': 'network-{}.network'.format(i),
             'path': '/etc/systemd/network/network-{}.network'.format(i),
@@ -209,130 +248,559 @@ def create_cloud_config_drive(machine):
             'command': 'start',
         })
 
-    user_data = '#cloud-config\n\n' + yaml.dump(user_data)
+    user_data = yaml.dump(user_data, Dumper=SafeDumper,
+                          default_flow_style=False)
+    user_data = ('#cloud-config\n\n' + user_data).encode()
 
     config_iso = os.path.join(BASE_IMAGE_DIR, machine['instance_id'] + '-config.iso')
-    tmpdir = mkdtemp()
-    meta_data_file = os.path.join(tmpdir, 'meta-data')
-    user_data_file = os.path.join(tmpdir, 'user-data')
 
-    with open(meta_data_file, 'w') as f:
-        f.write(meta_data)
-        meta_data_file = f.name
+    iso = pycdlib.PyCdlib()
+    if machine['os_variant'] == 'coreos':
+        # coreos reads its config from an openstack style config
+        # drive, with user-data at openstack/latest/user_data
+        iso.new(interchange_level=3, joliet=3, rock_ridge='1.09',
+                vol_ident='config-2')
+        iso.add_directory('/OPENSTACK', rr_name='openstack',
+                          joliet_path='/openstack')
+        iso.add_directory('/OPENSTACK/LATEST', rr_name='latest',
+                          joliet_path='/openstack/latest')
+        iso.add_fp(io.BytesIO(user_data), len(user_data),
+                   '/OPENSTACK/LATEST/USER_DATA.;1', rr_name='user_data',
+                   joliet_path='/openstack/latest/user_data')
+    else:
+        iso.new(interchange_level=3, joliet=3, rock_ridge='1.09',
+                vol_ident='cidata')
+        iso.add_fp(io.BytesIO(user_data), len(user_data),
+                   '/USER_DATA.;1', rr_name='user-data',
+                   joliet_path='/user-data')
+    iso.add_fp(io.BytesIO(meta_data), len(meta_data),
+               '/META_DATA.;1', rr_name='meta-data',
+               joliet_path='/meta-data')
+    iso.write(config_iso)
+    iso.close()
 
-    with open(user_data_file, 'w') as f:
-        f.write(user_data)
-        user_data_file = f.name
+    return os.path.abspath(config_iso)
 
-    try:
-        os.unlink(config_iso)
-    except FileNotFoundError:
-        pass
+images = {
+    ('linux', 'ubuntu'): {
+        'filename': 'ubuntu-16.04-server-cloudimg-amd64-disk1.img',
+        'url': 'https://cloud-images.ubuntu.com/releases/releases/16.04/release/ubuntu-16.04-server-cloudimg-amd64-disk1.img',
+        'checksums_url': 'https://cloud-images.ubuntu.com/releases/releases/16.04/release/SHA256SUMS',
+    },
+    ('linux', 'centos'): {
+        'filename': 'CentOS-7-x86_64-GenericCloud-1503.qcow2',
+        'url': 'http://cloud.centos.org/centos/7/images/CentOS-7-x86_64-GenericCloud-1503.qcow2.xz',
+        'checksums_url': 'http://cloud.centos.org/centos/7/images/sha256sum.txt',
+    },
+    ('linux', 'coreos'): {
+        'filename': 'coreos_production_qemu_image.img',
+        'url': 'https://alpha.release.core-os.net/amd64-usr/current/coreos_production_qemu_image.img.bz2',
+        'checksums_url': None,
+    },
+}
 
-    if machine['os_variant'] == 'coreos':
-        cmd = 'genisoimage -o {} -V config-2 -r -graft-points ' \
-              '-J openstack/latest/user_data={} {}'.format(
-                  config_iso, user_data_file, meta_data_file)
-    else:
-        cmd = 'genisoimage -o {} -V cidata -r -J {} {}'.format(
-            config_iso, user_data_file, meta_data_file)
-    code, out, err = run_cmd(cmd)
-    if code != 0:
-        raise RuntimeError('Error creating ISO image: ' + \
-                           err.decode() if err else out.decode())
+decompressors = {
+    '.xz': lzma.LZMADecompressor,
+    '.gz': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    '.bz2': bz2.BZ2Decompressor,
+}
 
-    os.unlink(meta_data_file)
-    os.unlink(user_data_file)
-    os.rmdir(tmpdir)
+def decompress_stream(chunks, new_decompressor):
+    decompressor = new_decompressor()
+    for data in chunks:
+        while data:
+            # files can contain several compressed streams back to back
+            # (pbzip2 produces these, for example)
+            if decompressor.eof:
+                decompressor = new_decompressor()
+            yield decompressor.decompress(data)
+            data = decompressor.unused_data if decompressor.eof else b''
 
-    return os.path.abspath(config_iso)
+    if not decompressor.eof:
+        raise RuntimeError('Compressed image is truncated.')
+
+DOWNLOAD_PIECE_SIZE = 8 * 2**20
 
-image_fetch_request_queue = Queue()
-image_fetch_result_queue = Queue()
-def fetch_image():
+DOWNLOAD_BUFFER_SIZE = 4 * 2**20
+
+# more than this tends to get us throttled, or even errors, from some
+# mirrors.
+DOWNLOAD_WORKERS = 4
+
+def download_stream(url, progress):
+    import requests
+
+    response = requests.get(url, stream=True)
+    response.raise_for_status()
+    response.raw.decode_content = True
     while True:
-        os_type, os_variant = image_fetch_request_queue.get()
-        if os_type == None:
+        data = response.raw.read(DOWNLOAD_BUFFER_SIZE)
+        if not data:
             break
+        progress.update(len(data))
+        yield data
+
+# yields the contents of the given url in order, while fetching several
+# pieces of it in parallel with ranged requests.
+def download_pieces(url, total, progress, offset=0):
+    import requests
+
+    local = threading.local()
+    progress_lock = threading.Lock()
+
+    def fetch_piece(start):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        end = min(start + DOWNLOAD_PIECE_SIZE, total) - 1
+        response = local.session.get(
+            url, headers={'Range': 'bytes={}-{}'.format(start, end)})
+        response.raise_for_status()
+        if response.status_code != 206 or \
+           len(response.content) != end - start + 1:
+            raise RuntimeError('Server did not honor range request.')
+        with progress_lock:
+            progress.update(len(response.content))
+        return response.content
+
+    # only a limited number of pieces are fetched ahead of the one
+    # being consumed, so memory use stays bounded.
+    starts = iter(range(offset, total, DOWNLOAD_PIECE_SIZE))
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        in_flight = deque(executor.submit(fetch_piece, start) for start
+                          in islice(starts, 2 * DOWNLOAD_WORKERS))
+        while in_flight:
+            data = in_flight.popleft().result()
+            start = next(starts, None)
+            if start is not None:
+                in_flight.append(executor.submit(fetch_piece, start))
+            yield data
+
+def hash_chunks(chunks, hash):
+    for data in chunks:
+        hash.update(data)
+        yield data
+
+image_fetch_executor = ThreadPoolExecutor()
+image_fetch_futures = {}
+image_fetch_lock = threading.Lock()
+
+def get_checksums_file(image):
+    return os.path.join(BASE_IMAGE_DIR, image['filename'] + '.sha256sums')
+
+def find_checksum(checksums, target_filename):
+    for line in checksums.splitlines():
+        parts = line.split()
+        # sha256sum marks binary files with a '*' before the name
+        if len(parts) == 2 and parts[1].lstrip('*') == target_filename:
+            return parts[0].lower()
+
+def get_image_checksum(image, target_filename):
+    if not image['checksums_url']:
+        return None
+
+    # the distribution's checksum list is cached next to the images
+    checksums_file = get_checksums_file(image)
+    checksum = None
+    if os.path.exists(checksums_file):
+        with open(checksums_file) as f:
+            checksum = find_checksum(f.read(), target_filename)
+
+    # a cached list that doesn't mention the image is probably stale
+    if not checksum:
+        import requests
+        response = requests.get(image['checksums_url'])
+        response.raise_for_status()
+        with open(checksums_file, 'w') as f:
+            f.write(response.text)
+        checksum = find_checksum(response.text, target_filename)
+
+    if not checksum:
+        os.unlink(checksums_file)
+        print('Warning: No checksum found for {}, the image will not be '
+              'verified.'.format(target_filename))
+
+    return checksum
+
+def download_image(os_type, os_variant):
+    image = images[os_type, os_variant]
+    path = os.path.join(BASE_IMAGE_DIR, image['filename'])
+    if os.path.exists(path):
+        return path
+
+    import requests
+    import yarl
+    from tqdm import tqdm
+
+    _, target_filename = os.path.split(yarl.URL(image['url']).path)
+    _, ext = os.path.splitext(target_filename)
+    checksum = get_image_checksum(image, target_filename)
+
+    # the image is decompressed while it's being downloaded, into a
+    # temporary name, so that an interrupted download is never mistaken
+    # for a complete image.
+    response = requests.head(image['url'], allow_redirects=True)
+    response.raise_for_status()
+    total = int(response.headers.get('Content-Length'))
+    supports_ranges = response.headers.get('Accept-Ranges') == 'bytes'
+
+    # a partial download can be resumed if the image isn't compressed;
+    # the decompressor can't pick up in the middle of a stream.
+    sha256 = hashlib.sha256()
+    offset = 0
+    if supports_ranges and ext not in decompressors and \
+       os.path.exists(path + '.part'):
+        offset = os.path.getsize(path + '.part')
+        if offset > total:
+            offset = 0
+        else:
+            with open(path + '.part', 'rb') as f:
+                for data in iter(lambda: f.read(2**20), b''):
+                    sha256.update(data)
+
+    with tqdm(total=total, initial=offset, unit='B', unit_scale=True,
+              desc='Downloading ' + target_filename) as progress:
+        if supports_ranges:
+            chunks = download_pieces(response.url, total, progress, offset)
+        else:
+            chunks = download_stream(response.url, progress)
+        chunks = hash_chunks(chunks, sha256)
+
+        if ext in decompressors:
+            chunks = decompress_stream(chunks, decompressors[ext])
 
-        if os_type == 'linux':
-            if os_variant == 'ubuntu':
-                filename = 'ubuntu-16.04-server-cloudimg-amd64-disk1.img'
-                url = 'https://cloud-images.ubuntu.com/releases/releases/16.04/release/ubuntu-16.04-server-cloudimg-amd64-disk1.img'
-            elif os_variant == 'centos':
-                filename = 'CentOS-7-x86_64-GenericCloud-1503.qcow2'
-                url = 'http://cloud.centos.org/centos/7/images/CentOS-7-x86_64-GenericCloud-1503.qcow2.xz'
-            elif os_variant == 'coreos':
-                filename = 'coreos_production_qemu_image.img'
-                url = 'https://alpha.release.core-os.net/amd64-usr/current/coreos_production_qemu_image.img.bz2'
-
-        path = os.path.join(BASE_IMAGE_DIR, filename)
-        if not os.path.exists(path):
-            _, target_filename = os.path.split(yarl.URL(url).path)
-            target = os.path.join(BASE_IMAGE_DIR, target_filename)
-            response = requests.get(url, stream=True)
-            total = int(response.headers.get('Content-Length'))
-            with open(target, 'wb') as f:
-                chunk_size = 2**20
-                for data in tqdm(response.iter_content(chunk_size),
-                                 total=total/chunk_size, unit='MiB',
-                                 desc='Downloading disk image'):
-                    f.write(data)
-
-            code = 0
-            if target_filename.endswith('.xz'):
-                print('Decompressing image...')
-                code, out, err = run_cmd('unxz {}'.format(target))
-            elif target_filename.endswith('.gz'):
-                print('Decompressing image...')
-                code, out, err = run_cmd('gunzip {}'.format(target))
-            elif target_filename.endswith('.bz2'):
-                print('Decompressing image...')
-                code, out, err = run_cmd('bunzip2 {}'.format(target))
-
-            if code != 0:
-                raise RuntimeError('Error decompressing image:' + \
-                                   err.decode() if err else out)
-
-        image_fetch_result_queue.put(path)
+        # the chunks are already large, so they're written straight to
+        # the file descriptor instead of through another buffer.
+        flags = os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC
+        flags |= os.O_APPEND if offset else os.O_TRUNC
+        fd = os.open(path + '.part', flags, 0o644)
+        try:
+            for data in chunks:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+    if checksum and sha256.hexdigest() != checksum:
+        # the cached checksum list might be the stale one, so fetch it
+        # again next time too.
+        os.unlink(path + '.part')
+        os.unlink(get_checksums_file(image))
+        raise RuntimeError('Checksum mismatch for ' + target_filename)
+
+    os.rename(path + '.part', path)
+    return path
+
+# starts fetching the given image in the background, unless it's
+# already being fetched, and returns a future for its path.
+def fetch_image(os_type, os_variant):
+    key = (os_type, os_variant)
+    with image_fetch_lock:
+        if key not in image_fetch_futures:
+            image_fetch_futures[key] = image_fetch_executor.submit(
+                download_image, os_type, os_variant)
+        return image_fetch_futures[key]
 
 def get_image(os_type, os_variant):
-    image_fetch_request_queue.put((os_type, os_variant))
-    return image_fetch_result_queue.get()
+    return fetch_image(os_type, os_variant).result()
+
+volume_template = ET.fromstring('''<volume>
+  <name/>
+  <target>
+    <format type='qcow2'/>
+  </target>
+  <backingStore>
+    <path/>
+    <format type='qcow2'/>
+  </backingStore>
+</volume>
+''')
+
+def get_filesystem_type(path):
+    path = os.path.realpath(path)
+    fs_type = None
+    longest_match = -1
+    with open('/proc/mounts') as f:
+        for line in f:
+            _, mount_point, mount_fs_type = line.split()[:3]
+            mount_point = mount_point.replace('\\040', ' ')
+            prefix = mount_point.rstrip('/') + '/'
+            if (path == mount_point or path.startswith(prefix)) and \
+               len(mount_point) > longest_match:
+                fs_type = mount_fs_type
+                longest_match = len(mount_point)
+    return fs_type
+
+@lru_cache(maxsize=None)
+def image_dir_on_btrfs():
+    return get_filesystem_type(BASE_IMAGE_DIR) == 'btrfs'
+
+pool_template = ET.fromstring('''<pool type='dir'>
+  <name>spinup</name>
+  <target>
+    <path/>
+  </target>
+</pool>
+''')
+
+image_pool_lock = threading.Lock()
+
+def get_image_pool(conn):
+    with image_pool_lock:
+        try:
+            pool = conn.storagePoolLookupByTargetPath(BASE_IMAGE_DIR)
+        except libvirt.libvirtError:
+            print('Creating storage pool for {}...'.format(BASE_IMAGE_DIR))
+            tree = copy.deepcopy(pool_template)
+            tree.find('target/path').text = BASE_IMAGE_DIR
+            pool = conn.storagePoolDefineXML(
+                ET.tostring(tree, encoding='unicode'), 0)
+            pool.setAutostart(1)
+
+        if not pool.isActive():
+            pool.create(0)
 
-def create_disk_image(base_image, machine):
+    return pool
+
+def create_disk_image(conn, base_image, machine):
     print('{}: Creating disk image...'.format(machine['name']))
-    image_filename = os.path.join(BASE_IMAGE_DIR, machine['instance_id'] + '-disk.img')
-    cmd = 'qemu-img create -f qcow2 -b {base_image} {image_filename}'.format(
-        base_image=base_image,
-        image_filename=image_filename)
+
+    tree = copy.deepcopy(volume_template)
+    tree.find('name').text = machine['instance_id'] + '-disk.img'
+    tree.find('backingStore/path').text = base_image
+
+    # when no size is given, libvirt uses the capacity of the backing
+    # image
     if machine.get('disk_size'):
-        cmd += ' ' + machine['disk_size']
-    code, out, err = run_cmd(cmd)
-    if code != 0:
-        raise RuntimeError('Error creating image: ' + \
-                           err.decode() if err else out.decode())
-    return image_filename
+        capacity = ET.SubElement(tree, 'capacity',
+                                 unit=machine['disk_size'][-1])
+        capacity.text = machine['disk_size'][:-1]
+
+    # copy-on-write badly fragments vm images on btrfs. prepare.sh
+    # marks the image directory +C so new files inherit the flag; the
+    # disks also ask libvirt for it, in case the directory wasn't.
+    if image_dir_on_btrfs():
+        ET.SubElement(tree.find('target'), 'nocow')
+
+    xml = ET.tostring(tree, encoding='unicode')
 
-def get_machine_ip_addrs(conn, domain, machine):
-    xml = domain.XMLDesc()
-    tree = ET.fromstring(xml)
-    mac = tree.find('./devices/interface[@type="network"]/mac').attrib['address']
+    pool = get_image_pool(conn)
+    try:
+        vol = pool.createXML(xml, 0)
+    except libvirt.libvirtError as e:
+        raise RuntimeError('Error creating image: ' + str(e))
+    return vol.path()
+
+warm_snapshot_template = ET.fromstring('''<domainsnapshot>
+  <disks>
+    <disk name='vda' snapshot='external'>
+      <source/>
+    </disk>
+    <disk name='hda' snapshot='no'/>
+  </disks>
+</domainsnapshot>
+''')
+
+warm_images_in_progress = set()
+warm_images_lock = threading.Lock()
+
+def get_warm_image(machine):
+    # a disk can't be smaller than its backing image, so warm images
+    # are only used for machines with the default disk size.
+    if machine.get('disk_size'):
+        return None
+
+    fingerprint = hashlib.sha256(
+        read_public_key().strip().encode()).hexdigest()[:12]
+    return os.path.join(WARM_IMAGE_DIR, '{}-{}.qcow2'.format(
+        machine['os_variant'], fingerprint))
+
+def wait_for_cloud_init(machine, ip, timeout=600):
+    # cloud-init is usually still busy when ssh comes up, so wait for it
+    # to finish, and for the guest to flush what it wrote, before the
+    # disk is copied. images without cloud-init (coreos) only sync.
+    username = DEFAULT_USERNAMES[machine['os_variant']]
+    try:
+        code, out, err = run_cmd([
+            'ssh',
+            '-o', 'StrictHostKeyChecking=no',
+            '-o', 'UserKnownHostsFile=/dev/null',
+            '-o', 'LogLevel=QUIET',
+            '-o', 'BatchMode=yes',
+            '{}@{}'.format(username, ip),
+            'if command -v cloud-init >/dev/null; then '
+            'while [ ! -e /var/lib/cloud/instance/boot-finished ]; '
+            'do sleep 1; done; fi; sync',
+        ], timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise RuntimeError('Timed out waiting for cloud-init.')
 
+    if code != 0:
+        raise RuntimeError('Error waiting for cloud-init: ' +
+                           (err or out).decode())
+
+def download_volume(conn, path, target):
+    # the disk is owned by libvirt, so it's read through libvirt instead
+    # of directly.
+    vol = conn.storageVolLookupByPath(path)
+    stream = conn.newStream(0)
+    try:
+        with open(target, 'wb') as f:
+            vol.download(stream, 0, 0, 0)
+            stream.recvAll(lambda stream, data, f: f.write(data), f)
+        stream.finish()
+    except Exception:
+        stream.abort()
+        raise
+
+def commit_active_layer(conn, domain, disk, timeout=600):
+    # an active commit reports that it's ready once the overlay has
+    # been merged into its backing file. the domain is then pivoted
+    # back to the backing file, which ends the job.
+    statuses = []
+    done = threading.Event()
+
+    def block_job_event_cb(conn, dom, event_disk, job_type, status, opaque):
+        if event_disk == disk:
+            statuses.append(status)
+            done.set()
+
+    callback_id = conn.domainEventRegisterAny(
+        domain, libvirt.VIR_DOMAIN_EVENT_ID_BLOCK_JOB_2,
+        block_job_event_cb, None)
+    try:
+        domain.blockCommit(disk, None, None, 0,
+                           libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE)
+        if not done.wait(timeout):
+            domain.blockJobAbort(disk, 0)
+            raise RuntimeError('Timed out merging the disk overlay.')
+    finally:
+        conn.domainEventDeregisterAny(callback_id)
+
+    if statuses[0] != libvirt.VIR_DOMAIN_BLOCK_JOB_READY:
+        raise RuntimeError('Could not merge the disk overlay.')
+    domain.blockJobAbort(disk, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+
+def save_warm_image(conn, domain, machine, ip, warm_image):
+    # in case there are multiple cold machines of the same kind in
+    # the cluster, only save one of them.
+    with warm_images_lock:
+        if warm_image in warm_images_in_progress:
+            return
+        warm_images_in_progress.add(warm_image)
+
+    print('{}: Waiting for cloud-init to finish...'.format(machine['name']))
+    wait_for_cloud_init(machine, ip)
+
+    print('{}: Saving warm image...'.format(machine['name']))
+    os.makedirs(WARM_IMAGE_DIR, exist_ok=True)
+
+    # redirect the guest's writes to a temporary overlay so that the
+    # disk image doesn't change while it's being copied, then merge the
+    # overlay back in. the copy keeps the disk's backing image.
+    overlay = machine['disk_image'] + '.warm'
+    tree = copy.deepcopy(warm_snapshot_template)
+    tree.find('disks/disk[@name="vda"]/source').set('file', overlay)
+    domain.snapshotCreateXML(
+        ET.tostring(tree, encoding='unicode'),
+        libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY |
+        libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA |
+        libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC)
+    try:
+        download_volume(conn, machine['disk_image'], warm_image + '.part')
+    except Exception:
+        if os.path.exists(warm_image + '.part'):
+            os.unlink(warm_image + '.part')
+        raise
+    finally:
+        # if this fails, the machine keeps running on the overlay
+        commit_active_layer(conn, domain, 'vda')
+        os.unlink(overlay)
+
+    os.rename(warm_image + '.part', warm_image)
+
+def get_domain_info(domain):
+    tree = ET.fromstring(domain.XMLDesc())
+    return {
+        'disk': tree.find('./devices/disk[@device="disk"]/source').attrib['file'],
+        'cdrom': tree.find('./devices/disk[@device="cdrom"]/source').attrib['file'],
+    }
+
+def get_machine_ip_addrs(conn, machine):
+    # the mac addresses are already in the machine description, so
+    # there's no need to fetch and parse the domain xml for them.
     ips = []
     for network in machine['networks']:
         if network['ip'] == 'dhcp':
-            ips.extend(lease['ipaddr'] for lease
-                       in conn.networkLookupByName(network['network']).DHCPLeases()
-                       if lease['mac'] == mac)
+            leases = conn.networkLookupByName(network['network']).DHCPLeases(
+                network['mac'])
+            ips.extend(lease['ipaddr'] for lease in leases)
         else:
             iface = ip_interface(network['ip'])
             ips.append(iface.ip)
 
     return ips
 
+def wait_for_ip_addrs(conn, domain, machine, timeout=120):
+    ips = get_machine_ip_addrs(conn, machine)
+    if ips:
+        return ips
+
+    # libvirt does not report lease changes as events, so the leases
+    # are re-checked periodically. domain events let us notice a
+    # machine that dies before it gets an address.
+    wakeup = threading.Event()
+    domain_stopped = threading.Event()
+
+    def domain_event_cb(conn, dom, event, detail, opaque):
+        if event in (libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                     libvirt.VIR_DOMAIN_EVENT_CRASHED):
+            domain_stopped.set()
+        wakeup.set()
+
+    domain_callback_id = conn.domainEventRegisterAny(
+        domain, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, domain_event_cb, None)
+
+    try:
+        deadline = time.monotonic() + timeout
+        while not ips:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError('{}: Timed out waiting for an IP '
+                                   'address.'.format(machine['name']))
+            if wakeup.wait(min(remaining, 0.1)):
+                wakeup.clear()
+            if domain_stopped.is_set():
+                raise RuntimeError('{}: VM stopped while waiting for an IP '
+                                   'address.'.format(machine['name']))
+            ips = get_machine_ip_addrs(conn, machine)
+    finally:
+        conn.domainEventDeregisterAny(domain_callback_id)
+
+    return ips
+
+def wait_for_ssh(machine, ip, timeout=120):
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        # the port can be open before sshd is actually serving
+        # connections, so wait for its banner.
+        try:
+            with socket.create_connection((ip, 22), timeout=1) as sock:
+                if sock.recv(4, socket.MSG_WAITALL) == b'SSH-':
+                    return
+        except OSError:
+            # connection refused, no route to host (yet), etc.
+            pass
+
+        if time.monotonic() >= deadline:
+            raise RuntimeError('{}: Timed out waiting for SSH.'.format(
+                machine['name']))
+        time.sleep(min(2**attempt * 0.05, 1.0))
+        attempt += 1
+
 def process_mem_descriptor(conn, desc, match, machine):
-    value = int(match.group('value'))
+    value = int(match.group('mem_value'))
     unit = match.group('unit')
 
     if unit:
@@ -350,7 +818,7 @@ def process_mem_descriptor(conn, desc, match, machine):
     machine['memory'] = int(value / 2**20)
 
 def process_cpu_descriptor(conn, desc, match, machine):
-    value = int(match.group('value'))
+    value = int(match.group('cpu_value'))
 
     if value == 0:
         raise RuntimeError('Can\'t have zero CPUs.')
@@ -405,30 +873,55 @@ def process_network_descriptor(conn, desc, match, machine):
         'mac': generate_random_mac(),
     })
 
+# each descriptor kind becomes a named group in a single regular
+# expression, so each descriptor is matched once and dispatched on the
+# name of the group that matched.
 descriptor_processors = [
-    ('(?P<value>\\d+)(?P<unit>[KMGT])', process_mem_descriptor),
-    ('(?P<value>\\d+)cpus?', process_cpu_descriptor),
-    ('(?P<variant>ubuntu|centos|coreos)', process_os_descriptor),
-    (':(?P<name>\\w+)', process_name_descriptor),
-    ('disk=(?P<size>\\d+[KMGT])', process_disk_descriptor),
-    ('((?P<network>(\\w|-)+):)?(?P<ip>\\d+\\.\\d+\\.\\d+\\.\\d+/\\d+|dhcp)',
+    ('mem', '(?P<mem_value>\\d+)(?P<unit>[KMGT])', process_mem_descriptor),
+    ('cpu', '(?P<cpu_value>\\d+)cpus?', process_cpu_descriptor),
+    ('os', '(?P<variant>ubuntu|centos|coreos)', process_os_descriptor),
+    ('machine_name', ':(?P<name>\\w+)', process_name_descriptor),
+    ('disk', 'disk=(?P<size>\\d+[KMGT])', process_disk_descriptor),
+    ('net', '((?P<network>(\\w|-)+):)?(?P<ip>\\d+\\.\\d+\\.\\d+\\.\\d+/\\d+|dhcp)',
      process_network_descriptor),
 ]
 
-def get_machine(conn, index, path, descriptors):
-    global descriptor_processors
+descriptor_regex = re.compile(
+    '|'.join('(?P<{}>{})'.format(kind, regex)
+             for kind, regex, _ in descriptor_processors))
 
-    # start with a default machine
-    uuid4 = str(uuid.uuid4())
+descriptor_funcs = {kind: func for kind, _, func in descriptor_processors}
+
+# domain names are prefixed with the cluster id, which is derived from
+# the cluster's directory. this lets us find a cluster's domains
+# without fetching the metadata of every domain on the host. since it's
+# the same every time, anything that has to be unique to a machine
+# (instance id, image files) uses the machine's uuid instead.
+def get_cluster_id(path):
     path = path[:-1] if path.endswith('/') else path
     directory_name = os.path.split(path)[1]
-    cluster_id = directory_name + '-' + uuid4
+    path_hash = hashlib.sha1(path.encode()).hexdigest()[:8]
+    return directory_name + '-' + path_hash
+
+# older versions of spinup used the directory name plus a random uuid4
+# as the cluster id.
+def get_legacy_cluster_id_regex(path):
+    path = path[:-1] if path.endswith('/') else path
+    directory_name = os.path.split(path)[1]
+    return re.compile(
+        re.escape(directory_name) +
+        '-[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}-')
+
+def get_machine(conn, index, path, descriptors):
+    # start with a default machine
+    uuid4 = str(uuid.uuid4())
+    cluster_id = get_cluster_id(path)
     name = 'machine-' + str(index)
     machine = {
         'uuid': uuid4,
         'name': name,
         'cluster_id': cluster_id,
-        'instance_id': cluster_id + '-' + str(index),
+        'instance_id': cluster_id + '-' + uuid4,
         'description': '',
         'os_type': 'linux',
         'os_variant': 'ubuntu',
@@ -437,77 +930,115 @@ def get_machine(conn, index, path, descriptors):
         'networks': [],
     }
 
-    # compile regular expressions
-    processors = [(re.compile(regex), processor)
-                  for regex, processor in descriptor_processors]
-
     for desc in descriptors:
-        for regex, update_func in processors:
-            match = regex.fullmatch(desc)
-            if match:
-                update_func(conn, desc, match, machine)
-                break
-        else:
+        match = descriptor_regex.fullmatch(desc)
+        if not match:
             raise RuntimeError('Invalid descriptor: ' + desc)
+        descriptor_funcs[match.lastgroup](conn, desc, match, machine)
 
     return machine
 
-def create_single_vm(arg):
-    path, machine = arg
-    conn = libvirt.open(LIBVIRT_URI)
-    base_image = get_image(machine['os_type'], machine['os_variant'])
-    machine['disk_image'] = create_disk_image(base_image, machine)
-    machine['config_drive'] = create_cloud_config_drive(machine)
+@lru_cache(maxsize=None)
+def supports_io_uring(conn):
+    # io_uring needs linux 5.1, qemu 5.0 and libvirt 6.3
+    kernel_version = tuple(
+        int(part) for part in
+        re.match(r'(\d+)\.(\d+)', os.uname().release).groups())
+    return kernel_version >= (5, 1) and \
+        conn.getVersion() >= 5000000 and \
+        conn.getLibVersion() >= 6003000
+
+def build_domain_xml(conn, path, machine, fast_disk_io=True):
+    ns = {'spinup': SPINUP_NAMESPACE}
+    tree = copy.deepcopy(domain_template)
+
+    tree.find('name').text = '{}-{}'.format(machine['cluster_id'],
+                                            machine['name'])
+    tree.find('uuid').text = machine['uuid']
+    tree.find('title').text = machine['name']
+    tree.find('description').text = machine['description']
+    tree.find('metadata/spinup:instance/spinup:path', ns).text = path
+    tree.find('metadata/spinup:instance/spinup:machine', ns).text = \
+        json.dumps(machine, separators=(',', ':'))
+    tree.find('memory').text = str(machine['memory'])
+    tree.find('vcpu').text = str(machine['cpus'])
+
+    devices = tree.find('devices')
+    if fast_disk_io and supports_io_uring(conn):
+        driver = devices.find('disk[@device="disk"]/driver')
+        driver.set('cache', 'none')
+        driver.set('io', 'io_uring')
+    devices.find('disk[@device="disk"]/source').set(
+        'file', machine['disk_image'])
+    devices.find('disk[@device="cdrom"]/source').set(
+        'file', machine['config_drive'])
+    devices.find('filesystem/source').set('dir', path)
 
-    network_xml = ''
     for network in machine['networks']:
-        network_xml += '''
-        <interface type='network'>
-          <mac address='{mac}' />
-          <source network='{network}' />
-        </interface>
-        '''.format(**network)
+        interface = ET.SubElement(devices, 'interface', type='network')
+        ET.SubElement(interface, 'mac', address=network['mac'])
+        ET.SubElement(interface, 'source', network=network['network'])
 
-    pickled_machine = base64.b64encode(pickle.dumps(machine)).decode()
+    return ET.tostring(tree, encoding='unicode')
 
-    xml = xml_template.format(
-        path=path,
-        pickled_machine=pickled_machine,
-        network_xml=network_xml,
-        **machine)
+def create_single_vm(arg):
+    conn, path, machine = arg
+
+    # machines start from a warm image saved after the first boot of
+    # an earlier machine, if there is one.
+    warm_image = get_warm_image(machine)
+    if warm_image and os.path.exists(warm_image):
+        base_image = warm_image
+    else:
+        base_image = get_image(machine['os_type'], machine['os_variant'])
+    machine['disk_image'] = create_disk_image(conn, base_image, machine)
+    try:
+        machine['config_drive'] = create_cloud_config_drive(machine)
 
-    print('{}: Defining VM...'.format(machine['name']))
-    domain = conn.defineXML(xml)
+        xml = build_domain_xml(conn, path, machine)
+
+        print('{}: Defining VM...'.format(machine['name']))
+        domain = conn.defineXML(xml)
+    except Exception:
+        # destroy can't find the images of a machine that was never
+        # defined, so they're removed here.
+        conn.storageVolLookupByPath(machine['disk_image']).delete(0)
+        if 'config_drive' in machine:
+            os.unlink(machine['config_drive'])
+        raise
 
     print('{}: Launching VM...'.format(machine['name']))
-    domain.create()
+    try:
+        domain.create()
+    except libvirt.libvirtError:
+        # the versions don't tell whether io_uring is actually usable
+        # (qemu might be built without it, or it might be disabled), or
+        # whether the image directory supports O_DIRECT, which
+        # cache='none' needs.
+        if not supports_io_uring(conn):
+            raise
+        print('{}: Retrying with default disk I/O settings...'.format(
+            machine['name']))
+        domain = conn.defineXML(
+            build_domain_xml(conn, path, machine, fast_disk_io=False))
+        domain.create()
 
     print('{}: Waiting to find VM IP address...'.format(machine['name']))
-    xml = domain.XMLDesc()
-    tree = ET.fromstring(xml)
-    mac = tree.find('./devices/interface[@type="network"]/mac').attrib['address']
-
-    ips = get_machine_ip_addrs(conn, domain, machine)
-    while not ips:
-        ips = get_machine_ip_addrs(conn, domain, machine)
-        time.sleep(0.1)
+    ips = wait_for_ip_addrs(conn, domain, machine)
     ip = str(ips[0])
     print('{}: Machine IP address: {}'.format(machine['name'], ip))
 
     print('{}: Waiting for SSH port to open...'.format(machine['name']))
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    while True:
+    wait_for_ssh(machine, ip)
+
+    if warm_image and base_image != warm_image:
+        # the machine itself is fine at this point, so failing to save
+        # the warm image isn't an error.
         try:
-            sock.connect((ip, 22))
-        except ConnectionRefusedError:
-            pass
-        except OSError:
-            # (possibly?) no route to host
-            pass
-        else:
-            sock.close()
-            break
-        time.sleep(0.1)
+            save_warm_image(conn, domain, machine, ip, warm_image)
+        except (RuntimeError, OSError, libvirt.libvirtError) as e:
+            print('{}: Warning: could not save warm image: {}'.format(
+                machine['name'], e))
 
     print('{}: VM created successfully.'.format(machine['name']))
 
@@ -550,11 +1081,9 @@ def create_vm(conn, path, args):
     if cluster:
         raise RuntimeError('A cluster is already running in this directory.')
 
-    pool = Pool(len(machines) + 1)
-    pool.apply_async(fetch_image, ())
-    pool.map(create_single_vm, [(path, m) for m in machines])
-
-    image_fetch_request_queue.put((None, None))
+    with ThreadPoolExecutor(max_workers=len(machines)) as executor:
+        list(executor.map(create_single_vm,
+                          [(conn, path, m) for m in machines]))
 
 def ssh_vm(conn, path, args):
     cluster = get_current_cluster(conn, path)
@@ -577,33 +1106,25 @@ def ssh_vm(conn, path, args):
         else:
             raise RuntimeError('No such machine in the cluster.')
 
-    xml = domain.XMLDesc()
-    tree = ET.fromstring(xml)
-    mac = tree.find('./devices/interface[@type="network"]/mac').attrib['address']
-    ips = get_machine_ip_addrs(conn, domain, machine)
+    ips = get_machine_ip_addrs(conn, machine)
     if not ips:
         raise RuntimeError('Can\'t find an IP address for the VM.')
     ip = ips[0]
 
-    username = get_default_username(machine)
+    username = DEFAULT_USERNAMES[machine['os_variant']]
 
-    cmd = 'ssh -o StrictHostKeyChecking=no '
-    cmd += '-o UserKnownHostsFile=/dev/null '
-    cmd += '-o LogLevel=QUIET '
-    cmd += '{}@{}'.format(username, ip)
-
-    subprocess.call(cmd.split(' '))
+    subprocess.call([
+        'ssh',
+        '-o', 'StrictHostKeyChecking=no',
+        '-o', 'UserKnownHostsFile=/dev/null',
+        '-o', 'LogLevel=QUIET',
+        '{}@{}'.format(username, ip),
+    ])
 
 def destroy_single_vm(arg):
-    domain_name, machine = arg
-
-    conn = libvirt.open(LIBVIRT_URI)
-    domain = conn.lookupByName(domain_name)
+    conn, domain, machine = arg
 
-    xml = domain.XMLDesc()
-    tree = ET.fromstring(xml)
-    disk_file = tree.find('./devices/disk[@device="disk"]/source').attrib['file']
-    config_drive_file = tree.find('./devices/disk[@device="cdrom"]/source').attrib['file']
+    info = get_domain_info(domain)
 
     print('{}: Destroying VM...'.format(machine['name']))
     try:
@@ -616,8 +1137,15 @@ def destroy_single_vm(arg):
     domain.undefine()
 
     print('{}: Removing disk images...'.format(machine['name']))
-    os.unlink(disk_file)
-    os.unlink(config_drive_file)
+    try:
+        vol = conn.storageVolLookupByPath(info['disk'])
+    except libvirt.libvirtError:
+        # disks created by older versions of spinup weren't created
+        # through the storage pool, so it might not know about them yet.
+        get_image_pool(conn).refresh(0)
+        vol = conn.storageVolLookupByPath(info['disk'])
+    vol.delete(0)
+    os.unlink(info['cdrom'])
 
     print('{}: VM destroyed.'.format(machine['name']))
 
@@ -626,8 +1154,43 @@ def destroy_vm(conn, path, args):
     if not cluster:
         raise RuntimeError('No cluster found in this directory.')
 
-    pool = Pool(len(cluster))
-    pool.map(destroy_single_vm, [(d.name(), m) for d, m in cluster])
+    with ThreadPoolExecutor(max_workers=len(cluster)) as executor:
+        list(executor.map(destroy_single_vm,
+                          [(conn, d, m) for d, m in cluster]))
+
+# calls func on all the machines in the cluster and waits until all of
+# them have reached the given state, as reported by lifecycle events.
+def apply_and_wait_for_state(conn, cluster, func, event, state, timeout=120):
+    pending = {d.UUIDString() for d, _ in cluster}
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def reached(uuid):
+        with lock:
+            pending.discard(uuid)
+            if not pending:
+                done.set()
+
+    def lifecycle_event_cb(conn, domain, event_type, detail, opaque):
+        if event_type == event:
+            reached(domain.UUIDString())
+
+    callback_id = conn.domainEventRegisterAny(
+        None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, lifecycle_event_cb, None)
+    try:
+        for domain, machine in cluster:
+            func(domain, machine)
+
+        # domains that were already in the desired state won't report
+        # an event.
+        for domain, _ in cluster:
+            if domain.state()[0] == state:
+                reached(domain.UUIDString())
+
+        if not done.wait(timeout):
+            raise RuntimeError('Timed out waiting for VMs.')
+    finally:
+        conn.domainEventDeregisterAny(callback_id)
 
 def shutdown_vm(conn, path, args):
     cluster = get_current_cluster(conn, path)
@@ -640,7 +1203,7 @@ def shutdown_vm(conn, path, args):
         if len(cluster) == 0:
             raise RuntimeError('No machine named "{}" found.'.format(name))
 
-    for domain, machine in cluster:
+    def shutdown(domain, machine):
         print('{}: Shutting VM down...'.format(machine['name']))
         try:
             domain.shutdown()
@@ -648,8 +1211,9 @@ def shutdown_vm(conn, path, args):
             # the domain is already shut off.
             pass
 
-    while all(d.state()[0] != libvirt.VIR_DOMAIN_SHUTOFF for d, _ in cluster):
-        time.sleep(0.1)
+    apply_and_wait_for_state(conn, cluster, shutdown,
+                             libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                             libvirt.VIR_DOMAIN_SHUTOFF)
 
 def start_vm(conn, path, args):
     cluster = get_current_cluster(conn, path)
@@ -662,12 +1226,13 @@ def start_vm(conn, path, args):
         if len(cluster) == 0:
             raise RuntimeError('No machine named "{}" found.'.format(name))
 
-    for domain, machine in cluster:
+    def start(domain, machine):
         print('{}: Starting VM...'.format(machine['name']))
         domain.create()
 
-    while all(d.state()[0] != libvirt.VIR_DOMAIN_RUNNING for d, _ in cluster):
-        time.sleep(0.1)
+    apply_and_wait_for_state(conn, cluster, start,
+                             libvirt.VIR_DOMAIN_EVENT_STARTED,
+                             libvirt.VIR_DOMAIN_RUNNING)
 
 def status_vm(conn, path, args):
     cluster = get_current_cluster(conn, path)
@@ -704,9 +1269,22 @@ cmd_to_func = {
     'status': status_vm,
 }
 
+usage = '''Usage: spinup [create] [descriptor...] [-- descriptor...]
+       spinup ssh [name]
+       spinup destroy
+       spinup shutdown [name]
+       spinup start [name]
+       spinup status [name]
+
+Descriptors: 4G (memory), 6cpus, ubuntu|centos|coreos, :name,
+disk=100G, [network:]10.3.0.10/24, dhcp. Use -- to separate machines.'''
+
 def process_args():
     args = sys.argv
-    if len(args) > 1 and args[1] in cmd_to_func:
+    if len(args) > 1 and args[1] in ('-h', '--help', 'help'):
+        cmd = 'help'
+        args = args[2:]
+    elif len(args) > 1 and args[1] in cmd_to_func:
         cmd = args[1]
         args = args[2:]
     else:
@@ -715,30 +1293,69 @@ def process_args():
 
     return cmd, args
 
+class MachineUnpickler(pickle.Unpickler):
+    # machines are only made of dicts, lists, strings and numbers, so
+    # there's never a class to load. refusing them keeps the metadata
+    # of a domain from running code.
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(
+            'Unexpected object in machine metadata: {}.{}'.format(
+                module, name))
+
+def get_domain_machine(domain):
+    try:
+        metadata = domain.metadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT,
+                                   SPINUP_NAMESPACE)
+    except libvirt.libvirtError as e:
+        # the domain has no spinup metadata, or it was undefined after
+        # it was listed. anything else (a dropped connection, say)
+        # mustn't pass for an empty cluster.
+        if e.get_error_code() in (libvirt.VIR_ERR_NO_DOMAIN_METADATA,
+                                  libvirt.VIR_ERR_NO_DOMAIN):
+            return None, None
+        raise
+
+    tree = ET.fromstring(metadata)
+    path = tree.find('./path').text
+    machine = tree.find('./machine')
+    if machine is not None:
+        return path, json.loads(machine.text)
+
+    # machines created by older versions of spinup are stored pickled
+    pickled_machine = base64.b64decode(tree.find('./pickled-machine').text)
+    return path, MachineUnpickler(io.BytesIO(pickled_machine)).load()
+
 def get_current_cluster(conn, source_dir):
+    prefix = get_cluster_id(source_dir) + '-'
+    legacy_regex = get_legacy_cluster_id_regex(source_dir)
+
     results = []
-    for domain in conn.listAllDomains():
-        machine = None
-        metadata = domain.metadata(libvirt.VIR_DOMAIN_METADATA_ELEMENT,
-                                   'http://spinup.io/instance')
-        if metadata:
-            tree = ET.fromstring(metadata)
-            path = tree.find('./path').text
-            if path == source_dir:
-                pickled_machine = tree.find('./pickled-machine').text
-                machine = pickle.loads(base64.b64decode(pickled_machine))
+    for domain in conn.listAllDomains(0):
+        name = domain.name()
+        if not name.startswith(prefix) and not legacy_regex.match(name):
+            continue
 
-                results.append((domain, machine))
+        path, machine = get_domain_machine(domain)
+        if path == source_dir:
+            results.append((domain, machine))
 
     return results
 
 def main():
     cwd = os.path.abspath(os.curdir)
 
+    # the arguments are handled before connecting to libvirt, so that
+    # asking for help doesn't have to wait for the connection.
+    cmd, args = process_args()
+    if cmd == 'help':
+        print(usage)
+        exit(0)
+
+    start_event_loop()
+
     print('Connecting to libvirt at {}...'.format(LIBVIRT_URI))
     conn = libvirt.open(LIBVIRT_URI)
-
-    cmd, args = process_args()
+    conn.setKeepAlive(5, 3)
 
     try:
         cmd_to_func[cmd](conn, cwd, args)